@@ -0,0 +1,104 @@
+# Finding the git checkouts under the home directory, shared by
+# all-status and all-fetch.
+#
+# Walking all of $HOME is slow, so what the walk found is cached in
+# ~/.cache/mesa-tools/home-repos.json: for every directory searched, its
+# mtime, whether it is a repo, and its subdirectories.  A directory's
+# mtime changes whenever an entry is added, removed or renamed in it, so
+# on the next run only directories whose mtime changed are listed again;
+# the rest just cost a stat.
+
+import json
+import os
+import os.path
+import tempfile
+
+HOME_DIR = os.path.expanduser('~')
+CACHE_DIR = os.path.join(HOME_DIR, '.cache', 'mesa-tools')
+CACHE_PATH = os.path.join(CACHE_DIR, 'home-repos.json')
+CACHE_VERSION = 1
+SKIP_DIRS = ('.platform', 'android', '.ccache', '.mozilla', 'patches', 'piglit-summary', 'intel-vpn')
+
+def printable_path(path):
+    if path.startswith(HOME_DIR + '/'):
+        return '~' + path[len(HOME_DIR):]
+    return path
+
+def git_dir(repo):
+    # .git is usually a directory, but is a "gitdir: ..." file in
+    # worktrees and submodules.
+    path = os.path.join(repo, '.git')
+    if os.path.isfile(path):
+        with open(path) as f:
+            contents = f.read()
+        if contents.startswith('gitdir:'):
+            return os.path.join(repo, contents[len('gitdir:'):].strip())
+    return path
+
+def load_cache():
+    try:
+        with open(CACHE_PATH) as f:
+            cache = json.load(f)
+        if cache.get('version') == CACHE_VERSION:
+            return cache['dirs']
+    except (OSError, ValueError):
+        pass
+    return {}
+
+def save_cache(dirs):
+    os.makedirs(CACHE_DIR, exist_ok = True)
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(CACHE_PATH))
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'dirs': dirs}, f)
+    os.replace(tmp_path, CACHE_PATH)
+
+def list_dir(path):
+    # Returns (is a repo, sorted subdirectories).  Symlinks are not
+    # followed.
+    subdirs = []
+    is_repo = False
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name == '.git':
+                is_repo = True
+            elif entry.name not in SKIP_DIRS and entry.is_dir(follow_symlinks = False):
+                subdirs.append(entry.name)
+    return is_repo, sorted(subdirs)
+
+def find_repos(root_dir = HOME_DIR):
+    # Returns the repos under root_dir, in the order a sorted depth-first
+    # walk finds them.  Repos are not searched for nested repos.
+    old_dirs = load_cache()
+    new_dirs = {}
+    repos = []
+    changed = False
+    stack = [root_dir]
+    while stack:
+        path = stack.pop()
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            changed = True
+            continue
+        entry = old_dirs.get(path)
+        if entry is None or entry['mtime'] != mtime:
+            try:
+                is_repo, subdirs = list_dir(path)
+            except OSError:
+                changed = True
+                continue
+            entry = {'mtime': mtime, 'repo': is_repo, 'subdirs': [] if is_repo else subdirs}
+            changed = True
+        new_dirs[path] = entry
+        if entry['repo']:
+            repos.append(path)
+        else:
+            stack.extend(os.path.join(path, subdir) for subdir in reversed(entry['subdirs']))
+    # Drop directories that are no longer reachable from root_dir, but keep
+    # those found by walks of other roots.
+    for path, entry in old_dirs.items():
+        if path not in new_dirs and not (path + '/').startswith(root_dir + '/'):
+            new_dirs[path] = entry
+    if changed or len(new_dirs) != len(old_dirs):
+        save_cache(new_dirs)
+    return repos
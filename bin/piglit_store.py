@@ -0,0 +1,376 @@
+# Columnar store of piglit results, shared by piglit-store, run-piglit
+# and view-piglit.
+#
+# Every test name gets a small integer id, kept in index.pickle along
+# with the list of runs.  Each run is stored as two columns indexed by
+# test id: a status code per test (array 'B') and a duration in seconds
+# (array 'f').  Comparing runs is then a walk down a few arrays, without
+# touching the original JSON results again.
+#
+# Runs are ingested from the "main" files piglit-run.py writes (JSON,
+# with a "tests" dict of test name -> {"result", "time", ...}).  A run is
+# named by its path relative to the results directory (~/piglit-results),
+# and is only re-ingested if the file's mtime or size changed.  When the
+# file turns out to hold a different run (run-piglit reuses the short
+# name), the old run is kept as <name>@<run id>, so the history the
+# analysis needs builds up.
+#
+# For analysis, runs are grouped by platform (taken from the run name)
+# and summed into per-platform Aggregate columns, kept in
+# aggregates.pickle.  New runs are added to those sums as they land; a
+# platform's sums are only rebuilt when one of its runs is re-ingested
+# or removed.
+
+import array
+import json
+import math
+import os
+import os.path
+import pickle
+import re
+import tempfile
+
+RESULTS_DIR = os.path.join(os.path.expanduser('~'), 'piglit-results')
+STORE_DIR = os.path.join(RESULTS_DIR, '.store')
+STORE_VERSION = 1
+AGGREGATES_VERSION = 1
+
+NOT_RUN = 'notrun'
+# From best to worst; statuses not listed count as 'fail'.
+SEVERITY = [NOT_RUN, 'skip', 'pass', 'warn', 'dmesg-warn', 'fail', 'dmesg-fail', 'timeout', 'crash', 'incomplete']
+# Statuses that say nothing about whether a test works.
+UNKNOWN_STATUSES = (NOT_RUN, 'skip')
+
+# run-piglit names runs <platform>-<UTC timestamp>-<short name>.
+RUN_NAME = re.compile(r'^(.*)-(\d{4}-\d\d-\d\d-\d{6})-(.*)$')
+
+def severity(status):
+    if status in SEVERITY:
+        return SEVERITY.index(status)
+    return SEVERITY.index('fail')
+
+def classify(before, after):
+    # 'regression', 'fix' or 'change' for a test whose status went from
+    # before to after.
+    if before not in UNKNOWN_STATUSES and after not in UNKNOWN_STATUSES:
+        if severity(after) > severity(before):
+            return 'regression'
+        if severity(after) < severity(before):
+            return 'fix'
+    return 'change'
+
+def parse_run_name(run_name):
+    # Returns (platform, timestamp), or (None, None) if run_name wasn't
+    # made by run-piglit.
+    m = RUN_NAME.match(run_name or '')
+    if m is None:
+        return None, None
+    return m.group(1), m.group(2)
+
+def file_key(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def write_pickle(path, obj):
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+class Aggregate(object):
+    # Per-test sums over a set of runs, as columns indexed by test id.
+    # Only runs in which a test actually ran (not notrun or skip) count
+    # towards it.
+    def __init__(self):
+        # run id -> file key of the run when it was added
+        self.runs = {}
+        self.ran = array.array('I')
+        self.passed = array.array('I')
+        self.duration_sum = array.array('d')
+        self.duration_sq_sum = array.array('d')
+        self.duration_max = array.array('f')
+
+    def grow(self, num_tests):
+        missing = num_tests - len(self.ran)
+        if missing > 0:
+            for column in (self.ran, self.passed, self.duration_sum, self.duration_sq_sum, self.duration_max):
+                column.frombytes(bytes(missing * column.itemsize))
+
+    def add(self, run_id, key, columns, ran_codes, pass_code):
+        statuses, durations = columns
+        self.grow(len(statuses))
+        ran = self.ran
+        passed = self.passed
+        duration_sum = self.duration_sum
+        duration_sq_sum = self.duration_sq_sum
+        duration_max = self.duration_max
+        for test_id, code in enumerate(statuses):
+            if code not in ran_codes:
+                continue
+            ran[test_id] += 1
+            if code == pass_code:
+                passed[test_id] += 1
+            duration = durations[test_id]
+            duration_sum[test_id] += duration
+            duration_sq_sum[test_id] += duration * duration
+            if duration > duration_max[test_id]:
+                duration_max[test_id] = duration
+        self.runs[run_id] = key
+
+    def duration_stats(self, test_id):
+        # (mean, standard deviation, max) of the test's duration.
+        n = self.ran[test_id]
+        if n == 0:
+            return 0.0, 0.0, 0.0
+        mean = self.duration_sum[test_id] / n
+        variance = max(0.0, self.duration_sq_sum[test_id] / n - mean * mean)
+        return mean, math.sqrt(variance), self.duration_max[test_id]
+
+def run_platform(info):
+    return info['platform'] or 'other'
+
+class Store(object):
+    def __init__(self, store_dir = STORE_DIR, results_dir = RESULTS_DIR):
+        self.store_dir = store_dir
+        self.results_dir = results_dir
+        self.index_path = os.path.join(store_dir, 'index.pickle')
+        index = None
+        try:
+            with open(self.index_path, 'rb') as f:
+                index = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        if index is None or index.get('version') != STORE_VERSION:
+            index = {'version': STORE_VERSION, 'tests': [], 'statuses': [NOT_RUN], 'runs': {},
+                     'not_results': {}, 'next_id': 0}
+        self.index = index
+        # test name -> test id
+        self.test_ids = dict((name, i) for i, name in enumerate(index['tests']))
+        self.status_codes = dict((status, i) for i, status in enumerate(index['statuses']))
+        self.loaded_columns = {}
+        self.changed = False
+
+    @property
+    def tests(self):
+        return self.index['tests']
+
+    @property
+    def statuses(self):
+        return self.index['statuses']
+
+    @property
+    def runs(self):
+        # run name -> {'id', 'source', 'key', 'run_name', 'platform',
+        # 'timestamp', 'time_elapsed', 'num_tests'[, 'superseded']}
+        return self.index['runs']
+
+    def save(self):
+        if self.changed:
+            os.makedirs(self.store_dir, exist_ok = True)
+            write_pickle(self.index_path, self.index)
+            self.changed = False
+
+    def test_id(self, name):
+        test_id = self.test_ids.get(name)
+        if test_id is None:
+            test_id = len(self.tests)
+            self.tests.append(name)
+            self.test_ids[name] = test_id
+        return test_id
+
+    def status_code(self, status):
+        code = self.status_codes.get(status)
+        if code is None:
+            code = len(self.statuses)
+            self.statuses.append(status)
+            self.status_codes[status] = code
+        return code
+
+    def columns_path(self, run_id):
+        return os.path.join(self.store_dir, 'runs', '{0}.pickle'.format(run_id))
+
+    def ingest(self, filename, name = None):
+        # Returns True if the run was (re-)ingested, False if the store
+        # was already up to date.
+        filename = os.path.abspath(filename)
+        if name is None:
+            name = os.path.relpath(filename, self.results_dir)
+        key = file_key(filename)
+        info = self.runs.get(name)
+        if info is not None and info['source'] == filename and info['key'] == key:
+            return False
+        with open(filename) as f:
+            results = json.load(f)
+        # Check the whole file before interning any names, so one that
+        # isn't a piglit result leaves the store as it was.
+        if not isinstance(results, dict) or not isinstance(results.get('tests'), dict):
+            raise ValueError('no "tests" object')
+        checked = []
+        for test, result in results['tests'].items():
+            status = result.get('result', NOT_RUN) if isinstance(result, dict) else None
+            if not isinstance(status, str):
+                raise ValueError('bad result for {0}'.format(test))
+            checked.append((test, status, float(result.get('time') or 0)))
+        if info is not None and info['source'] == filename and results.get('name') != info['run_name']:
+            # A new run in the old one's file: keep the old one too.
+            self.runs['{0}@{1}'.format(name, info['id'])] = dict(info, superseded = True)
+            info = None
+        entries = [(self.test_id(test), self.status_code(status), duration)
+                   for test, status, duration in checked]
+        statuses = array.array('B', bytes(len(self.tests)))
+        durations = array.array('f', bytes(4 * len(self.tests)))
+        for test_id, code, duration in entries:
+            statuses[test_id] = code
+            durations[test_id] = duration
+        if info is None:
+            run_id = self.index['next_id']
+            self.index['next_id'] += 1
+        else:
+            run_id = info['id']
+        os.makedirs(os.path.dirname(self.columns_path(run_id)), exist_ok = True)
+        write_pickle(self.columns_path(run_id), (statuses, durations))
+        self.loaded_columns.pop(run_id, None)
+        platform, timestamp = parse_run_name(results.get('name'))
+        self.runs[name] = {'id': run_id, 'source': filename, 'key': key,
+                           'run_name': results.get('name'), 'platform': platform,
+                           'timestamp': timestamp, 'time_elapsed': results.get('time_elapsed'),
+                           'num_tests': len(entries)}
+        self.changed = True
+        return True
+
+    def remove(self, name):
+        info = self.runs.pop(name)
+        try:
+            os.unlink(self.columns_path(info['id']))
+        except OSError:
+            pass
+        self.loaded_columns.pop(info['id'], None)
+        self.changed = True
+
+    def update(self, log = None):
+        # Ingest every new or changed file under the results directory,
+        # and forget runs whose file is gone (but not superseded ones,
+        # which are only kept here).  Files that turn out not to
+        # be piglit results are remembered too, so they aren't read again
+        # until they change.  Returns the names of the runs ingested.
+        ingested = []
+        seen = set()
+        not_results = self.index['not_results']
+        for dirpath, dirnames, filenames in os.walk(self.results_dir):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.results_dir)
+                seen.add(name)
+                key = file_key(path)
+                if not_results.get(name) == key:
+                    continue
+                try:
+                    if self.ingest(path, name):
+                        ingested.append(name)
+                        if log is not None:
+                            log('Ingested {0}'.format(name))
+                except (ValueError, KeyError, AttributeError, TypeError) as e:
+                    not_results[name] = key
+                    self.changed = True
+                    if log is not None:
+                        log('Skipping {0}: not a piglit result ({1})'.format(name, e))
+        for name in list(not_results):
+            if name not in seen:
+                del not_results[name]
+                self.changed = True
+        for name in list(self.runs):
+            info = self.runs[name]
+            if name not in seen and not info.get('superseded') and \
+               info['source'].startswith(self.results_dir + os.sep):
+                self.remove(name)
+        return ingested
+
+    def columns(self, name):
+        # (statuses, durations) for a run, both indexed by test id and as
+        # long as the test list.
+        run_id = self.runs[name]['id']
+        columns = self.loaded_columns.get(run_id)
+        if columns is None:
+            with open(self.columns_path(run_id), 'rb') as f:
+                statuses, durations = pickle.load(f)
+            missing = len(self.tests) - len(statuses)
+            if missing > 0:
+                statuses.frombytes(bytes(missing))
+                durations.frombytes(bytes(4 * missing))
+            columns = (statuses, durations)
+            self.loaded_columns[run_id] = columns
+        return columns
+
+    def select_runs(self, patterns):
+        # Like view-piglit always did: for each regexp, in order, the runs
+        # whose name ends in "/<regexp>", sorted.
+        selected = []
+        for pattern in patterns:
+            regexp = re.compile('/' + pattern + '$')
+            for name in sorted(self.runs):
+                if regexp.search('/' + name) and name not in selected:
+                    selected.append(name)
+        return selected
+
+    def status_counts(self, name):
+        # status -> number of tests, for the tests the run includes.
+        statuses = self.columns(name)[0]
+        counts = [0] * len(self.statuses)
+        for code in statuses:
+            counts[code] += 1
+        return dict((self.statuses[code], count) for code, count in enumerate(counts)
+                    if count and code != 0)
+
+    def compare(self, names):
+        # Returns [(test name, [status per run], kind)] for the tests whose
+        # status isn't the same in every run, sorted by test name.  kind
+        # compares the first run with the last (see classify()).
+        columns = [self.columns(name)[0] for name in names]
+        rows = []
+        for test_id, codes in enumerate(zip(*columns)):
+            if min(codes) != max(codes):
+                statuses = [self.statuses[code] for code in codes]
+                rows.append((self.tests[test_id], statuses, classify(statuses[0], statuses[-1])))
+        rows.sort()
+        return rows
+
+    def aggregates(self):
+        # platform -> Aggregate over all the stored runs of that platform,
+        # brought up to date incrementally.
+        path = os.path.join(self.store_dir, 'aggregates.pickle')
+        aggregates = None
+        try:
+            with open(path, 'rb') as f:
+                aggregates = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+            pass
+        if aggregates is None or aggregates.get('version') != AGGREGATES_VERSION:
+            aggregates = {'version': AGGREGATES_VERSION, 'platforms': {}}
+        platforms = aggregates['platforms']
+        runs_by_platform = {}
+        for name, info in self.runs.items():
+            runs_by_platform.setdefault(run_platform(info), []).append(name)
+        ran_codes = set(code for status, code in self.status_codes.items()
+                        if status not in UNKNOWN_STATUSES)
+        pass_code = self.status_codes.get('pass')
+        changed = False
+        for platform in list(platforms):
+            if platform not in runs_by_platform:
+                del platforms[platform]
+                changed = True
+        for platform, names in sorted(runs_by_platform.items()):
+            current = dict((self.runs[name]['id'], self.runs[name]['key']) for name in names)
+            aggregate = platforms.get(platform)
+            if aggregate is None or any(current.get(run_id) != key for run_id, key in aggregate.runs.items()):
+                aggregate = platforms[platform] = Aggregate()
+            for name in sorted(names):
+                info = self.runs[name]
+                if info['id'] not in aggregate.runs:
+                    aggregate.add(info['id'], info['key'], self.columns(name), ran_codes, pass_code)
+                    changed = True
+            aggregate.grow(len(self.tests))
+        if changed:
+            os.makedirs(self.store_dir, exist_ok = True)
+            write_pickle(path, aggregates)
+        return platforms
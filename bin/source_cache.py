@@ -0,0 +1,803 @@
+# Parsed models of the C/C++ and XML sources in a Mesa tree, shared by
+# global-rename-symbols and change-canonical-api.
+#
+# Tokenizing the whole tree is slow, so the parsed models are kept in a
+# persistent cache (one pickle per source tree, under
+# ~/.cache/mesa-tools).  Each entry is keyed by the file's mtime and
+# size; only files that changed since the last run are re-parsed.
+#
+# A CFile records where every identifier occurs, and FileCache
+# merges those into an identifier -> files index, so renames only visit
+# the files that actually contain the identifiers being renamed.
+#
+# Instead of walking the filesystem, the file set can also come from git
+# (git_read): either the index, in which case files that are clean with
+# respect to the index are cached by blob id and never opened, or any
+# tree-ish, in which case blobs are read with one "git cat-file --batch"
+# and the result is written back as new trees (write_tree) without
+# touching the working tree.  TreeWriter keeps one private index for a
+# whole series of such trees, so a run of commits can be built with git
+# plumbing straight from the in-memory models.
+#
+# FileCache.diff shows what the dirty models would write, without writing
+# it, and PhaseTimer backs the tools' --stats option.
+
+import array
+import concurrent.futures
+import contextlib
+import difflib
+import os
+import os.path
+import pickle
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+CACHE_VERSION = 6
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'mesa-tools')
+PARALLEL_PARSE_THRESHOLD = 64
+WRITE_THREADS = 8
+
+C_IDENTIFIER = re.compile('[a-zA-Z_][a-zA-Z0-9_]*')
+XML_TOKEN = re.compile('<[^>]+>')
+XML_IDENTIFIER = re.compile('[a-zA-Z0-9_:]+')
+WHITESPACE = re.compile('[ \t\n]+')
+XML_ATTR = re.compile('([a-zA-Z0-9_:]+)([ \t\n]*)(=)([ \t\n]*)(\'[^\']*\'|"[^"]*")')
+INDEXED_XML_TAGS = ('function', 'size')
+
+class File(object):
+    def __init__(self, filename, contents = None):
+        if contents is None:
+            with open(filename, 'r', encoding='latin-1') as f:
+                contents = f.read()
+        self.contents = contents
+
+    def set_contents(self, contents):
+        # Called once the output of serialize() has been written back.
+        self.contents = contents
+
+    @property
+    def dirty(self):
+        # Whether serialize() may differ from self.contents.
+        return True
+
+    @property
+    def hits(self):
+        # Number of changes made to the model, if it keeps count;
+        # otherwise diff() counts changed lines.
+        return None
+
+class CFile(File):
+    # Only the identifiers are recorded, as offsets into self.contents
+    # (identifier -> array of start offsets).  Renames are kept as
+    # pending replacements (offset -> (original length, new text)) and
+    # spliced in by serialize().
+    def __init__(self, filename, contents = None):
+        File.__init__(self, filename, contents)
+        self.tokenize()
+
+    def tokenize(self):
+        identifiers = {}
+        for match in C_IDENTIFIER.finditer(self.contents):
+            identifiers.setdefault(match.group(), []).append(match.start())
+        self.identifiers = dict((identifier, array.array('I', offsets))
+                                for identifier, offsets in identifiers.items())
+        self.replacements = {}
+
+    def set_contents(self, contents):
+        File.set_contents(self, contents)
+        self.tokenize()
+
+    def rename_identifiers(self, changes):
+        # changes maps old identifier -> new identifier.  All offsets
+        # are looked up before any are changed, so a batch containing
+        # both a => b and b => c renames each occurrence at most once.
+        hits = [(old, changes[old], self.identifiers.pop(old))
+                for old in changes if old in self.identifiers]
+        for old, new, offsets in hits:
+            for offset in offsets:
+                if offset in self.replacements:
+                    length = self.replacements[offset][0]
+                else:
+                    length = len(old)
+                self.replacements[offset] = (length, new)
+        for old, new, offsets in hits:
+            self.identifiers.setdefault(new, array.array('I')).extend(offsets)
+        return sum(len(offsets) for old, new, offsets in hits)
+
+    @property
+    def dirty(self):
+        return bool(self.replacements)
+
+    @property
+    def hits(self):
+        return len(self.replacements)
+
+    def serialize(self):
+        if not self.replacements:
+            return self.contents
+        pieces = []
+        pos = 0
+        for offset in sorted(self.replacements):
+            length, new = self.replacements[offset]
+            pieces.append(self.contents[pos:offset])
+            pieces.append(new)
+            pos = offset + length
+        pieces.append(self.contents[pos:])
+        return ''.join(pieces)
+
+class TreeNode(object):
+    # items holds strings and child nodes.  The serialized form is
+    # cached; anything that edits a node in place must call changed(),
+    # which drops the cached strings of the node and its ancestors and
+    # marks the document as modified.
+    __slots__ = ('items', 'parent', '_str')
+    # Slots that are not pickled, and come back as None.
+    transient = ('_str',)
+
+    def __init__(self, items):
+        self.items = items
+        self.parent = None
+        self._str = None
+        for item in items:
+            if isinstance(item, TreeNode):
+                item.parent = self
+
+    def changed(self):
+        node = self
+        while True:
+            node._str = None
+            if node.parent is None:
+                break
+            node = node.parent
+        if isinstance(node, XmlDocument):
+            node.modified = True
+        return node
+
+    def __str__(self):
+        if self._str is None:
+            self._str = ''.join(str(item) for item in self.items)
+        return self._str
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__qualname__,
+                                 ', '.join(repr(item) for item in self.items))
+
+    def __getstate__(self):
+        return dict((slot, getattr(self, slot))
+                    for cls in type(self).__mro__ for slot in getattr(cls, '__slots__', ())
+                    if slot not in self.transient)
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        for slot in self.transient:
+            setattr(self, slot, None)
+
+class XmlDocument(TreeNode):
+    # The top level of an XML file.  If attr_listener is set, it is
+    # called as attr_listener(element, key, old_value, new_value) after
+    # any attribute of an element in the document is set or unset.
+    __slots__ = ('modified', 'attr_listener')
+    transient = ('_str', 'attr_listener')
+
+    def __init__(self, items):
+        TreeNode.__init__(self, items)
+        self.modified = False
+        self.attr_listener = None
+
+class XmlAttr(object):
+    # name<space_before>=<space_after>value, where value keeps its quotes.
+    __slots__ = ('name', 'space_before', 'space_after', 'value')
+
+    def __init__(self, name, space_before, space_after, value):
+        self.name = name
+        self.space_before = space_before
+        self.space_after = space_after
+        self.value = value
+
+    def __str__(self):
+        return '{0}{1}={2}{3}'.format(self.name, self.space_before, self.space_after, self.value)
+
+    def __repr__(self):
+        return 'XmlAttr({0!r}, {1!r}, {2!r}, {3!r})'.format(
+            self.name, self.space_before, self.space_after, self.value)
+
+def ltrimsplit(s):
+    rhs = s.lstrip()
+    return s[:(len(s)-len(rhs))],rhs
+
+def rtrimsplit(s):
+    lhs = s.rstrip()
+    return lhs,s[len(lhs)]
+
+def parse_xml_open_part(s):
+    if s[0].isspace():
+        return ltrimsplit(s)
+    if s[0] in '/>':
+        return s, ''
+    match = XML_ATTR.match(s)
+    if match is None:
+        print(repr(s))
+    name, space_before, equals, space_after, value = match.groups()
+    return XmlAttr(name, space_before, space_after, value), s[match.end():]
+
+def split_xml_open_parts(s):
+    yield s[0]
+    s = s[1:]
+    match = XML_IDENTIFIER.match(s)
+    yield match.group()
+    s = s[match.end():]
+    while s:
+        part, s = parse_xml_open_part(s)
+        yield part
+
+class XmlOpen(TreeNode):
+    # items is ['<', tag, whitespace and XmlAttrs..., '>' or '/>'];
+    # attrs maps attribute name -> XmlAttr.
+    __slots__ = ('attrs',)
+
+    def __init__(self, s):
+        TreeNode.__init__(self, list(split_xml_open_parts(s)))
+        self.attrs = dict((part.name, part) for part in self.items[2:]
+                          if isinstance(part, XmlAttr))
+
+class XmlSpecial(TreeNode):
+    __slots__ = ()
+
+    def __init__(self, s):
+        TreeNode.__init__(self, [s])
+
+class Element(TreeNode):
+    __slots__ = ()
+
+    def __init__(self, items):
+        items[0] = XmlOpen(items[0])
+        TreeNode.__init__(self, items)
+
+    def tag(self):
+        return self.items[0].items[1]
+
+    def get_attr(self, key):
+        attr = self.items[0].attrs.get(key)
+        if attr is None:
+            return None
+        assert not '&' in attr.value
+        return attr.value[1:-1]
+
+    def get_attr_list(self):
+        result = []
+        for part in self.items[0].items[2:]:
+            if isinstance(part, XmlAttr):
+                assert not '&' in part.value
+                result.append((part.name, part.value[1:-1]))
+        return result
+
+    def attr_changed(self, key, old_value, new_value):
+        root = self.items[0].changed()
+        listener = getattr(root, 'attr_listener', None)
+        if listener is not None:
+            listener(self, key, old_value, new_value)
+
+    def unset_attr(self, key):
+        xml_open = self.items[0]
+        attr = xml_open.attrs.pop(key, None)
+        if attr is not None:
+            # Remove the attribute along with the whitespace before it.
+            i = next(i for i, part in enumerate(xml_open.items) if part is attr) - 1
+            del xml_open.items[i:(i + 2)]
+            self.attr_changed(key, attr.value[1:-1], None)
+
+    def set_attr(self, key, value):
+        xml_open = self.items[0]
+        value_str = '"{0}"'.format(value)
+        attr = xml_open.attrs.get(key)
+        if attr is not None:
+            old_value = attr.value[1:-1]
+            attr.value = value_str
+        else:
+            old_value = None
+            attr = XmlAttr(key, '', '', value_str)
+            xml_open.attrs[key] = attr
+            xml_open.items[-1:-1] = [' ', attr]
+        self.attr_changed(key, old_value, value)
+
+def parse_xml(tokens):
+    stack = [[XmlDocument, []]]
+    for token in tokens:
+        if token.startswith('<?') or token.startswith('<!'):
+            stack[-1][1].append(XmlSpecial(token))
+        elif not token.startswith('<'):
+            stack[-1][1].append(token)
+        elif token.endswith('/>'):
+            stack[-1][1].append(Element([token]))
+        elif token.startswith('</'):
+            assert len(stack) > 1
+            stack[-1][1].append(token)
+            cls, items = stack.pop()
+            stack[-1][1].append(cls(items))
+        else:
+            stack.append([Element, [token]])
+    if len(stack) != 1:
+        print('{0!r}'.format(stack))
+    assert len(stack) == 1
+    cls, items = stack[0]
+    return cls(items)
+
+def index_tags(items, tags, tag_index):
+    for item in items:
+        if isinstance(item, Element):
+            if item.tag() in tags:
+                tag_index[item.tag()].append(item)
+            index_tags(item.items[1:-1], tags, tag_index)
+
+class XmlFile(File):
+    # Besides the tree, the elements with tags in INDEXED_XML_TAGS are
+    # listed by tag when the file is parsed, and cached along with the
+    # tree.  Edits that move such elements must update tag_index.
+    def __init__(self, filename, contents = None):
+        File.__init__(self, filename, contents)
+        pos = 0
+        tokens = []
+        while pos < len(self.contents):
+            start = self.contents.find('<', pos)
+            if start == -1:
+                tokens.append(self.contents[pos:])
+                break
+            if self.contents[start:(start + 4)] == '<!--':
+                end = self.contents.find('-->', start + 4)
+                assert end != -1
+                end += 3
+            else:
+                match = XML_TOKEN.match(self.contents, start)
+                assert start == match.start()
+                end = match.end()
+            tokens.append(self.contents[pos:start])
+            tokens.append(self.contents[start:end])
+            pos = end
+        for token in tokens:
+            assert token.find('<') in (-1, 0)
+            if token.startswith('<?'):
+                assert token.endswith('?>')
+            if token.startswith('<!--'):
+                assert token.endswith('-->')
+            else:
+                assert token.find('>') in (-1, len(token) - 1)
+            if token.startswith('<'):
+                assert token.endswith('>')
+            if token.find('>') != -1:
+                assert token.startswith('<')
+        self.parsed = parse_xml(tokens)
+        self.tag_index = dict((tag, []) for tag in INDEXED_XML_TAGS)
+        index_tags(self.parsed.items, INDEXED_XML_TAGS, self.tag_index)
+
+    def set_contents(self, contents):
+        File.set_contents(self, contents)
+        self.parsed.modified = False
+
+    @property
+    def dirty(self):
+        return self.parsed.modified
+
+    def elements(self, tag):
+        # The elements with the given tag, in document order.
+        return self.tag_index[tag]
+
+    def serialize(self):
+        return str(self.parsed)
+
+C_FILE_TYPES = dict((ext, CFile) for ext in ('.cpp', '.hpp', '.cc', '.hh', '.c', '.h'))
+XML_FILE_TYPES = {'.xml': XmlFile}
+
+def token_cache_path(root_dir):
+    name = os.path.abspath(root_dir).strip(os.sep).replace(os.sep, '_')
+    return os.path.join(CACHE_DIR, 'tokens-{0}.pickle'.format(name))
+
+def parse_file(arg):
+    cls, filename, contents = arg
+    return cls(filename, contents)
+
+def write_model(item):
+    # Returns the new contents, or None if the file is unchanged.
+    filename, model = item
+    new_contents = model.serialize()
+    if new_contents == model.contents:
+        return None
+    with open(filename, 'w', encoding='latin-1') as f:
+        f.write(new_contents)
+    return new_contents
+
+def stat_key(st):
+    return (st.st_mtime_ns, st.st_size)
+
+def blob_key(sha):
+    return ('blob', sha)
+
+def git(root_dir, *args, input = None, env = None):
+    return subprocess.check_output(['git'] + list(args), cwd = root_dir, input = input, env = env)
+
+def decode_blob(data):
+    # Match what reading the file in text mode would have produced.
+    return data.decode('latin-1').replace('\r\n', '\n').replace('\r', '\n')
+
+def read_blobs(root_dir, shas):
+    # Yields the contents of each blob, using a single git process.
+    proc = subprocess.Popen(['git', 'cat-file', '--batch'], cwd = root_dir,
+                            stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+    try:
+        for sha in shas:
+            proc.stdin.write(sha.encode('ascii') + b'\n')
+            proc.stdin.flush()
+            header = proc.stdout.readline().split()
+            if len(header) != 3 or header[1] != b'blob':
+                raise Exception('Unexpected git cat-file output for {0}: {1!r}'.format(sha, header))
+            data = proc.stdout.read(int(header[2]))
+            proc.stdout.read(1)
+            yield decode_blob(data)
+    finally:
+        proc.stdin.close()
+        proc.wait()
+
+class TreeWriter(object):
+    # Builds a series of trees, starting from treeish, in a private
+    # index.  Each write_tree() only updates the entries that changed
+    # since the previous one, and all blobs go through a single
+    # long-running "git hash-object".
+    def __init__(self, root_dir, treeish):
+        self.root_dir = root_dir
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.env = dict(os.environ, GIT_INDEX_FILE = os.path.join(self.tmp_dir.name, 'index'))
+        self.blob_path = os.path.join(self.tmp_dir.name, 'blob')
+        self.modes = None
+        git(root_dir, 'read-tree', treeish, env = self.env)
+        self.hasher = subprocess.Popen(['git', 'hash-object', '-w', '--stdin-paths', '--no-filters'],
+                                       cwd = root_dir, stdin = subprocess.PIPE,
+                                       stdout = subprocess.PIPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.hasher.stdin.close()
+        self.hasher.wait()
+        self.tmp_dir.cleanup()
+
+    def hash_blob(self, contents):
+        with open(self.blob_path, 'w', encoding='latin-1') as f:
+            f.write(contents)
+        self.hasher.stdin.write(os.fsencode(self.blob_path) + b'\n')
+        self.hasher.stdin.flush()
+        return self.hasher.stdout.readline().decode('ascii').strip()
+
+    def mode(self, path):
+        # Mode of path in the tree being built, for files that weren't
+        # read through git, or None if the tree doesn't have it.
+        if self.modes is None:
+            self.modes = {}
+            for entry in git(self.root_dir, 'ls-files', '-s', '-z', env = self.env).split(b'\0'):
+                if entry:
+                    info, entry_path = entry.split(b'\t', 1)
+                    self.modes[os.fsdecode(entry_path)] = info.split()[0].decode('ascii')
+        return self.modes.get(path)
+
+    def write_tree(self, index_info):
+        # index_info is a list of (mode, blob id, path relative to root_dir).
+        if index_info:
+            git(self.root_dir, 'update-index', '-z', '--index-info',
+                input = b''.join(os.fsencode('{0} {1}\t{2}\0'.format(*entry)) for entry in index_info),
+                env = self.env)
+        return git(self.root_dir, 'write-tree', env = self.env).decode('ascii').strip()
+
+class PhaseTimer(object):
+    # Wall-clock time per named phase.  A phase may be entered more than
+    # once; the times add up.
+    def __init__(self):
+        self.names = []
+        self.totals = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if name not in self.totals:
+                self.names.append(name)
+                self.totals[name] = 0.0
+            self.totals[name] += time.perf_counter() - start
+
+    def report(self, out = sys.stderr):
+        for name in self.names:
+            out.write('{0:<10} {1:8.3f}s\n'.format(name, self.totals[name]))
+        out.write('{0:<10} {1:8.3f}s\n'.format('total', sum(self.totals.values())))
+
+def print_hit_report(report):
+    # report is the return value of FileCache.diff().
+    for path, hits in report:
+        print('{0:6} {1}'.format(hits, path))
+    print('{0:6} total in {1} files'.format(sum(hits for path, hits in report), len(report)))
+
+def commit_tree(root_dir, tree, parents, message):
+    args = ['commit-tree', tree]
+    for parent in parents:
+        args += ['-p', parent]
+    return git(root_dir, *args, input = message.encode('utf-8')).decode('ascii').strip()
+
+class FileCache(dict):
+    def __init__(self, file_types, cache_path = None):
+        self.file_types = file_types
+        self.cache_path = cache_path
+        self.cache_changed = False
+        self.cache = {}
+        self._identifier_index = None
+        # filename -> git file mode, for files read by git_read
+        self.git_modes = {}
+        if cache_path is not None:
+            self.load_cache()
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path, 'rb') as f:
+                cache = pickle.load(f)
+            if cache['cache_version'] == CACHE_VERSION:
+                self.cache = cache['files']
+            else:
+                print('Token cache is out of date.  Rebuilding.')
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print('Non-fatal error loading token cache: {0}'.format(e))
+
+    def save_cache(self):
+        if self.cache_path is None:
+            return
+        # Forget files that have disappeared, but keep entries for file
+        # types this cache doesn't read (they belong to the other tool).
+        for filename in list(self.cache):
+            if filename not in self and self.file_type(filename) is not None:
+                del self.cache[filename]
+                self.cache_changed = True
+        if not self.cache_changed:
+            return
+        # Models with unwritten edits no longer match their key.
+        files = dict((filename, entry) for filename, entry in self.cache.items()
+                     if not entry[1].dirty)
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok = True)
+        fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(self.cache_path))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'cache_version': CACHE_VERSION, 'files': files}, f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.cache_path)
+        self.cache_changed = False
+
+    def file_type(self, filename):
+        base, ext = os.path.splitext(filename)
+        return self.file_types.get(ext.lower())
+
+    def cached_model(self, filename, key, cls):
+        cached = self.cache.get(filename)
+        if cached is not None and cached[0] == key and isinstance(cached[1], cls):
+            return cached[1]
+        return None
+
+    def add_model(self, filename, key, model, from_cache):
+        self._identifier_index = None
+        self[filename] = model
+        if not from_cache:
+            self.cache[filename] = (key, model)
+            self.cache_changed = True
+
+    def read_file(self, filename):
+        cls = self.file_type(filename)
+        if cls is None:
+            return
+        key = stat_key(os.stat(filename))
+        model = self.cached_model(filename, key, cls)
+        if model is not None:
+            self.add_model(filename, key, model, True)
+        else:
+            self.add_model(filename, key, cls(filename), False)
+
+    def identifier_index(self):
+        # identifier -> set of filenames of the CFiles containing it
+        if self._identifier_index is None:
+            index = {}
+            for filename, model in self.items():
+                if isinstance(model, CFile):
+                    for identifier in model.identifiers:
+                        index.setdefault(identifier, set()).add(filename)
+            self._identifier_index = index
+        return self._identifier_index
+
+    def rename_c_identifiers(self, changes):
+        # Apply a whole batch of renames, touching only the files that
+        # contain one of the old identifiers.  Returns the number of
+        # tokens changed.
+        index = self.identifier_index()
+        filenames = set()
+        for old in changes:
+            filenames.update(index.get(old, ()))
+        count = 0
+        for filename in filenames:
+            model = self[filename]
+            count += model.rename_identifiers(changes)
+            for identifier in set(changes) | set(changes.values()):
+                if identifier in model.identifiers:
+                    index.setdefault(identifier, set()).add(filename)
+                elif identifier in index:
+                    index[identifier].discard(filename)
+        return count
+
+    def scan(self, root_dir):
+        # Returns (filename, stat key, model class) for each file under
+        # root_dir that this cache reads.  Symlinks and .git are skipped.
+        found = []
+        stack = [root_dir]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_symlink():
+                        continue
+                    if entry.is_dir():
+                        if entry.name != '.git':
+                            stack.append(entry.path)
+                    else:
+                        cls = self.file_type(entry.name)
+                        if cls is not None:
+                            key = stat_key(entry.stat(follow_symlinks = False))
+                            found.append((entry.path, key, cls))
+        found.sort()
+        return found
+
+    def parse_files(self, to_parse):
+        # Tokenizing is CPU bound, so spread big batches over a pool of
+        # worker processes.
+        args = [(cls, filename, contents) for filename, key, cls, contents in to_parse]
+        if len(args) < PARALLEL_PARSE_THRESHOLD:
+            return [parse_file(arg) for arg in args]
+        workers = os.cpu_count() or 1
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            return list(executor.map(parse_file, args,
+                                     chunksize = max(1, len(args) // (workers * 4))))
+
+    def recursive_read(self, root_dir):
+        if os.path.isfile(root_dir):
+            self.read_file(root_dir)
+            return
+        to_parse = []
+        for filename, key, cls in self.scan(root_dir):
+            model = self.cached_model(filename, key, cls)
+            if model is not None:
+                self.add_model(filename, key, model, True)
+            else:
+                to_parse.append((filename, key, cls, None))
+        for (filename, key, cls, contents), model in zip(to_parse, self.parse_files(to_parse)):
+            self.add_model(filename, key, model, False)
+
+    def git_read(self, root_dir, treeish = None):
+        # Read the files git knows about.  With no treeish, the working
+        # tree versions of the files in the index are read; files whose
+        # index entry is clean are cached by blob id.  With a treeish,
+        # the files are read from that tree instead.
+        if treeish is None:
+            entries = []
+            for record in git(root_dir, 'ls-files', '-s', '-z').split(b'\0'):
+                if record:
+                    info, path = record.split(b'\t', 1)
+                    mode, sha, stage = info.decode('ascii').split()
+                    entries.append((mode, sha, stage, os.fsdecode(path)))
+            git(root_dir, 'update-index', '-q', '--refresh')
+            modified = set(os.fsdecode(path) for path in
+                           git(root_dir, 'diff-files', '--name-only', '-z').split(b'\0'))
+        else:
+            entries = []
+            for record in git(root_dir, 'ls-tree', '-r', '-z', treeish).split(b'\0'):
+                if record:
+                    info, path = record.split(b'\t', 1)
+                    mode, obj_type, sha = info.decode('ascii').split()
+                    if obj_type == 'blob':
+                        entries.append((mode, sha, '0', os.fsdecode(path)))
+            modified = set()
+        to_parse = []
+        for mode, sha, stage, path in entries:
+            cls = self.file_type(path)
+            if cls is None or mode == '120000':
+                continue
+            filename = os.path.join(root_dir, path)
+            if path in modified or stage != '0':
+                try:
+                    key = stat_key(os.lstat(filename))
+                except FileNotFoundError:
+                    continue
+                sha = None
+            else:
+                key = blob_key(sha)
+            self.git_modes[filename] = mode
+            model = self.cached_model(filename, key, cls)
+            if model is not None:
+                self.add_model(filename, key, model, True)
+            else:
+                to_parse.append([filename, key, cls, sha])
+        if treeish is not None:
+            blobs = read_blobs(root_dir, [item[3] for item in to_parse])
+            for item, contents in zip(to_parse, blobs):
+                item[3] = contents
+        else:
+            for item in to_parse:
+                item[3] = None
+        for (filename, key, cls, contents), model in zip(to_parse, self.parse_files(to_parse)):
+            self.add_model(filename, key, model, False)
+
+    def write_tree(self, tree_writer):
+        # Write the dirty models as blobs and return the id of a tree
+        # with them in place (see TreeWriter).  The working tree and
+        # the real index are left alone.
+        index_info = []
+        for filename, model in sorted(self.items()):
+            if not model.dirty:
+                continue
+            new_contents = model.serialize()
+            if new_contents == model.contents:
+                continue
+            path = os.path.relpath(filename, tree_writer.root_dir)
+            mode = self.git_modes.get(filename) or tree_writer.mode(path)
+            if mode is None:
+                # Untracked (e.g. generated) files don't belong in the
+                # tree.
+                print('Skipped untracked {0}'.format(path))
+                continue
+            sha = tree_writer.hash_blob(new_contents)
+            index_info.append((mode, sha, path))
+            model.set_contents(new_contents)
+            self.cache[filename] = (blob_key(sha), model)
+            self.cache_changed = True
+            print('Wrote {0} ({1})'.format(path, sha[:7]))
+        return tree_writer.write_tree(index_info)
+
+    def diff(self, root_dir):
+        # Stream a unified diff of what the dirty models would write, and
+        # return [(path, hits)] for the files that would change.  Nothing
+        # is written, and the models are left dirty.
+        sys.stdout.flush()
+        out = sys.stdout.buffer
+        report = []
+        for filename, model in sorted(self.items()):
+            if not model.dirty:
+                continue
+            new_contents = model.serialize()
+            if new_contents == model.contents:
+                continue
+            path = os.path.relpath(filename, root_dir)
+            changed_lines = 0
+            for line in difflib.unified_diff(model.contents.splitlines(True),
+                                             new_contents.splitlines(True),
+                                             'a/' + path, 'b/' + path):
+                if line[0] == '-' and not line.startswith('--- a/'):
+                    changed_lines += 1
+                if not line.endswith('\n'):
+                    line += '\n\\ No newline at end of file\n'
+                out.write(line.encode('latin-1'))
+            out.flush()
+            report.append((path, model.hits if model.hits is not None else changed_lines))
+        return report
+
+    def write_files(self):
+        # Only dirty models are serialized; the writes themselves are
+        # spread over a few threads.
+        dirty = [(filename, model) for filename, model in self.items() if model.dirty]
+        with concurrent.futures.ThreadPoolExecutor(WRITE_THREADS) as executor:
+            results = list(executor.map(write_model, dirty))
+        for (filename, model), new_contents in zip(dirty, results):
+            if new_contents is None:
+                continue
+            model.set_contents(new_contents)
+            # The model still describes the file, so keep it cached
+            # under the file's new stat info.
+            self.cache[filename] = (stat_key(os.stat(filename)), model)
+            self.cache_changed = True
+            print('Wrote {0}'.format(filename))
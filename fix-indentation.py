@@ -1,10 +1,30 @@
-# Fix indentation in a python file to use 4 spaces.
+# Fix indentation in python files to use 4 spaces.
+#
+# usage: fix-indentation.py [--check] PATH...
+#
+# Directories are searched for *.py files.  Each file is tokenized once;
+# logical lines are sliced out of the text by offset and the result is
+# written incrementally to a temporary file that replaces the original
+# atomically.  Several files are processed in parallel.
+#
+# Files found to be clean are remembered in ~/.cache/fix-indentation,
+# by content hash and by stat info, so unchanged files are skipped
+# without even being read on the next run.  With --check, files that
+# need fixing are listed instead of rewritten.
 
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
 import re
 import sys
+import tempfile
 
 INDENTATION_REGEXP = re.compile('[ \t]*')
 PARSE_POINT = re.compile('[\n\'"()\\[\\]{}#\\\\]')
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'fix-indentation', 'clean.json')
+CACHE_VERSION = 1
 
 def test():
     """foo
@@ -47,7 +67,7 @@ def find_string_end(text, delimiter, pos):
 
 
 def pre_parse(text):
-    # Break the input into tokens and yield (token_type, text)
+    # Break the input into tokens and yield (token_type, start, end)
     # Token types are:
     # 'string'
     # 'comment'
@@ -60,46 +80,48 @@ def pre_parse(text):
         m = PARSE_POINT.search(text, pos)
         if not m:
             if pos < len(text):
-                yield 'text', text[pos:]
+                yield 'text', pos, len(text)
             break
-        if m.start() > pos:
-            yield 'text', text[pos:m.start()]
-        if m.group()[0] in '\'"':
-            if m.end() + 2 <= len(text) \
-                    and text[m.end()] == m.group() \
-                    and text[m.end()+1] == m.group():
-                delimiter = m.group() * 3
+        start, end = m.span()
+        c = m.group()
+        if start > pos:
+            yield 'text', pos, start
+        if c in '\'"':
+            if end + 2 <= len(text) \
+                    and text[end] == c \
+                    and text[end+1] == c:
+                delimiter = c * 3
             else:
-                delimiter = m.group()
+                delimiter = c
             string_end = find_string_end(text,
                                          delimiter,
-                                         m.start() + len(delimiter))
-            yield 'string', text[m.start():string_end]
+                                         start + len(delimiter))
+            yield 'string', start, string_end
             pos = string_end
             continue
-        if m.group() == '\n':
-            yield 'newline', m.group()
-        elif m.group() in '([{':
-            yield 'open', m.group()
-        elif m.group() in ')]}':
-            yield 'close', m.group()
-        elif m.group() == '#':
-            comment_end = text.find('\n', m.end())
+        if c == '\n':
+            yield 'newline', start, end
+        elif c in '([{':
+            yield 'open', start, end
+        elif c in ')]}':
+            yield 'close', start, end
+        elif c == '#':
+            comment_end = text.find('\n', end)
             if comment_end == -1:
                 comment_end = len(text)
-            yield 'comment', text[m.start():comment_end]
+            yield 'comment', start, comment_end
             pos = comment_end
             continue
-        elif m.group() == '\\':
-            if m.end() < len(text) and text[m.end()] == '\n':
-                yield 'text', '\\\n'
-                pos = m.end() + 1
+        elif c == '\\':
+            if end < len(text) and text[end] == '\n':
+                yield 'text', start, end + 1
+                pos = end + 1
                 continue
             else:
-                yield 'text', m.group()
+                yield 'text', start, end
         else:
-            raise Exception(m.group())
-        pos = m.end()
+            raise Exception(c)
+        pos = end
 
 
 def measure_indent(str):
@@ -113,14 +135,11 @@ def measure_indent(str):
 
 class LogicalLine(object):
     def __init__(self, str):
-        self.physical_lines = str.split('\n')
-        self.indent_amount, self.indent_str = measure_indent(
-            self.physical_lines[0])
-        self.normal_indent = all(
-            len(p) == 0 or p.isspace() or p.startswith(self.indent_str)
-            for p in self.physical_lines)
-        self.is_empty = len(self.physical_lines) == 1 \
-            and self.indent_str == self.physical_lines[0]
+        # str may span several physical lines; they are only split
+        # apart if the line actually has to be reindented.
+        self.str = str
+        self.indent_amount, self.indent_str = measure_indent(str)
+        self.is_empty = self.indent_str == str
 
     def reindent(self, new_amount):
         delta = new_amount - self.indent_amount
@@ -130,28 +149,30 @@ class LogicalLine(object):
                 return ''
             return ' '*(old_amount + delta) + phys_line[len(old_indent_str):]
         if self.indent_amount == 0 and new_amount == 0:
-            return '\n'.join(self.physical_lines)
-        elif self.normal_indent:
+            return self.str
+        if '\n' not in self.str:
+            return reindent_phys_line(self.str)
+        physical_lines = self.str.split('\n')
+        if all(len(p) == 0 or p.isspace() or p.startswith(self.indent_str)
+               for p in physical_lines):
             return '\n'.join(reindent_phys_line(phys_line)
-                             for phys_line in self.physical_lines)
+                             for phys_line in physical_lines)
         else:
-            return reindent_phys_line('\n'.join(self.physical_lines))
+            return reindent_phys_line(self.str)
 
 
 def parse_logical_lines(text):
-    logical_line = ''
+    line_start = 0
     nesting = 0
-    for token_type, str in pre_parse(text):
+    for token_type, start, end in pre_parse(text):
         if token_type == 'newline' and nesting == 0:
-            yield LogicalLine(logical_line)
-            logical_line = ''
-            continue
+            yield LogicalLine(text[line_start:start])
+            line_start = end
         elif token_type == 'open':
             nesting += 1
         elif token_type == 'close' and nesting > 0:
             nesting -= 1
-        logical_line += str
-    yield LogicalLine(logical_line)
+    yield LogicalLine(text[line_start:])
 
 
 def fix_tabs(text, new_indent = 4):
@@ -170,8 +191,148 @@ def fix_tabs(text, new_indent = 4):
         yield line.reindent(new_indents[-1])
 
 
-with open(sys.argv[1], 'r') as f:
-    new_contents = '\n'.join(fix_tabs(f.read()))
+def is_clean(text):
+    # Whether fix_tabs() would leave text alone.  Stops at the first
+    # difference.
+    pos = 0
+    separator = ''
+    for line in fix_tabs(text):
+        chunk = separator + line
+        if not text.startswith(chunk, pos):
+            return False
+        pos += len(chunk)
+        separator = '\n'
+    return pos == len(text)
+
+
+def write_fixed(filename, text):
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)),
+        prefix='.' + os.path.basename(filename) + '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            separator = ''
+            for line in fix_tabs(text):
+                f.write(separator)
+                f.write(line)
+                separator = '\n'
+        os.chmod(tmp_filename, os.stat(filename).st_mode & 0o7777)
+        os.rename(tmp_filename, filename)
+    except:
+        os.unlink(tmp_filename)
+        raise
+
+
+# Hashes of file contents known to be clean, shared with the pool
+# workers.
+clean_hashes = set()
+
+def set_clean_hashes(hashes):
+    global clean_hashes
+    clean_hashes = hashes
+
+
+def process_file(arg):
+    # Returns (filename, status, content hash, error), where status is
+    # 'clean', 'fixed', 'unclean' (found with check set) or 'error'.
+    filename, check = arg
+    try:
+        with open(filename, 'r') as f:
+            text = f.read()
+        content_hash = hashlib.sha1(text).hexdigest()
+        if content_hash in clean_hashes or is_clean(text):
+            return filename, 'clean', content_hash, None
+        if check:
+            return filename, 'unclean', content_hash, None
+        write_fixed(filename, text)
+        return filename, 'fixed', content_hash, None
+    except Exception as e:
+        return filename, 'error', None, '{0}: {1}'.format(filename, e)
+
+
+def find_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            for filename in sorted(filenames):
+                if filename.endswith('.py'):
+                    yield os.path.join(dirpath, filename)
+
+
+def stat_key(filename):
+    st = os.stat(filename)
+    return [st.st_mtime, st.st_size]
+
+
+def load_cache():
+    # Returns (clean content hashes, {absolute path: [stat key, hash]}).
+    try:
+        with open(CACHE_PATH) as f:
+            cache = json.load(f)
+        if cache.get('version') == CACHE_VERSION:
+            return set(cache['hashes']), cache['files']
+    except (IOError, ValueError):
+        pass
+    return set(), {}
+
+
+def save_cache(hashes, files):
+    cache_dir = os.path.dirname(CACHE_PATH)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'hashes': sorted(hashes), 'files': files}, f)
+    os.rename(tmp_path, CACHE_PATH)
+
+
+def main(paths, check):
+    hashes, files = load_cache()
+    cache_changed = False
+    work = []
+    for filename in find_files(paths):
+        abs_filename = os.path.abspath(filename)
+        entry = files.get(abs_filename)
+        try:
+            if entry is not None and entry[0] == stat_key(filename) and entry[1] in hashes:
+                continue
+        except OSError:
+            pass
+        work.append((filename, check))
+    if len(work) > 1:
+        pool = multiprocessing.Pool(initializer=set_clean_hashes, initargs=(hashes,))
+        results = pool.imap(process_file, work, chunksize=4)
+    else:
+        set_clean_hashes(hashes)
+        results = (process_file(arg) for arg in work)
+    failed = False
+    for filename, status, content_hash, error in results:
+        if status == 'clean':
+            hashes.add(content_hash)
+            files[os.path.abspath(filename)] = [stat_key(filename), content_hash]
+            cache_changed = True
+        elif status == 'unclean':
+            print(filename)
+            failed = True
+        elif status == 'error':
+            sys.stderr.write(error + '\n')
+            failed = True
+    if len(work) > 1:
+        pool.close()
+        pool.join()
+    if cache_changed:
+        save_cache(hashes, files)
+    return 1 if failed else 0
+
 
-with open(sys.argv[1], 'w') as f:
-    f.write(new_contents)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fix indentation in python files to use 4 spaces')
+    parser.add_argument('--check', action='store_true',
+                        help='List the files that need fixing, and write nothing')
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='Python file, or directory to search for *.py files')
+    args = parser.parse_args()
+    sys.exit(main(args.paths, args.check))
@@ -17,37 +17,23 @@ import re
 SAFE_SUBJECT_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
 PATCH_REGEXP = re.compile(r'\[[A-Z ]*PATCH')
 CACHE_VERSION = 9
-KNOWN_EMAILS = {
-    'maraeo@gmail.com': u'Marek Olšák',
-    'sroland@vmware.com': 'Roland Scheidegger',
-    'ville.syrjala@linux.intel.com': u'Ville Syrjälä',
-    'bugzilla-daemon@freedesktop.org': '(bugzilla)',
-    'jfonseca@vmware.com': u'José Fonseca',
-    'alexdeucher@gmail.com': 'Alex Deucher',
-    'junyan.he@linux.intel.com': 'Junyan He',
-    'j.glisse@gmail.com': 'Jerome Glisse',
-    'chad.versace@linux.intel.com': 'Chad Versace',
-    'groleo@gmail.com': 'Adrian Marius Negreanu',
-    'Ritvik_Sharma@Dell.com': 'Ritvik Sharma',
-    'piglit-bounces@lists.freedesktop.org': '(bounce)',
-    'Dmitry@freedesktop.org': 'Dmitry Cherkassov',
-    'tom@stellard.net': 'Tom Stellard',
-    'tstellar@gmail.com': 'Tom Stellard',
-    'oliver.mcfadden@linux.intel.com': 'Oliver McFadden',
-    'anuj.phogat@gmail.com': 'Anuj Phogat',
-    'jbenton@vmware.com': 'James Benton',
-    'zhiwen.wu@linux.intel.com': 'Alex Wu',
-    'mandeep.baines@gmail.com': 'Mandeep Singh Baines',
-    'jose.r.fonseca@gmail.com': u'José Fonseca',
-    'zhigang.gong@linux.intel.com': 'Zhigang Gong',
-    'juan.j.zhao@linux.intel.com': 'Juan Zhao',
-    'kallisti5@unixzen.com': 'Alexander von Gluck IV',
-    'christoph@bumiller.com': 'Christoph Bumiller',
-    'tfogal@sci.utah.edu': 'Tom Fogal',
-    'deathsimple@vodafone.de': u'Christian König',
-    'younes.m@gmail.com': 'Younes Manton',
-    'tapani.palli@intel.com': u'Tapani Pälli',
-}
+# Names by (lowercased) address, from the index built by bin/reviewers,
+# or just the seeds it starts from if it hasn't been built yet.
+REVIEWERS_INDEX = os.path.expanduser('~/.cache/mesa-tools/reviewers.json')
+REVIEWERS_SEEDS = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'reviewers.json')
+
+
+def load_known_emails():
+    for path, key in ((REVIEWERS_INDEX, 'by_email'), (REVIEWERS_SEEDS, 'names')):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)[key]
+        except (IOError, ValueError, KeyError):
+            pass
+    return {}
+
+
+KNOWN_EMAILS = load_known_emails()
 
 PATCHES_DIR = os.path.expanduser('~/patches')
 
@@ -180,8 +166,8 @@ def make_patches_from_mail_folder(folder_name, summary_data, old_cache, new_cach
 def short_sender(sender):
     NAME_WIDTH = 16
     real, addr = email.utils.parseaddr(sender)
-    if addr in KNOWN_EMAILS:
-        name = KNOWN_EMAILS[addr]
+    if addr.lower() in KNOWN_EMAILS:
+        name = KNOWN_EMAILS[addr.lower()]
     elif real:
         name = real
     else: